@@ -7,7 +7,9 @@ a = Analysis(['main.py'],
              pathex=['.'],
              binaries=[],
              datas=[('scripts', 'scripts')],
-             hiddenimports=[],
+             # watchdog is optional, it lets the drawing list refresh itself when
+             # files change. Its windows backend is picked at runtime so list it here
+             hiddenimports=['watchdog.observers.read_directory_changes'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -1,37 +1,70 @@
-import glob
 import logging
 import logging.handlers
 import multiprocessing as mp
+import os
 import queue
 import tkinter as tk
-from os import path
-import re
-from typing import List
+from itertools import chain
+from typing import Dict, Iterable, List, Tuple
 from tkinter import ttk, filedialog, messagebox as mbox
 
-from .log_handlers import LogDispatcher
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    # watchdog is optional, without it the file list only refreshes on directory change
+    FileSystemEventHandler = object
+    Observer = None
+
+from .log_handlers import LogDispatcher, configure_main_logging
 from .pipeline import DrawingProcessor
-from .utility import autocad_console
 
 
 class LogDisplay(ttk.LabelFrame):
     """
     Simple tkinter frame for a log console window. Creates a queue 
-    which is checked every 100ms for new log entries. Queue expects 
+    which is checked every 30ms for new log entries. Queue expects 
     entries to be a string, a log handler should be in charge of 
-    formatting the string
+    formatting the string. Only the most recent lines are kept in the window
     """
-    def __init__(self, master, **options):
+    MAXIMUM_BLOCK_COUNT = 5000
+    POLL_MS = 30
+
+    def __init__(self, master, max_lines: int = MAXIMUM_BLOCK_COUNT, poll_ms: int = POLL_MS, **options):
         """
         Initialise log window, starts checking for messages immediately
 
         :param master: tk master widget
+        :param max_lines: maximum number of lines kept in the console
+        :param poll_ms: interval in ms between checks of the queue
         :param options: options to passthrough to tk.Frame
         """
         super(LogDisplay, self).__init__(master, **options)
-        self.queue = mp.Queue()
-        self.console = tk.Text(self, height=10)
-        self.console.grid(stick="nesw")
+        self._max_lines = max_lines
+        self.poll_ms = poll_ms
+        # filled by the log dispatcher thread in this process, so no pipe or pickling needed
+        self.queue = queue.Queue()
+        # plain read-only console, no undo stack or line wrapping to maintain
+        self.console = tk.Text(
+            self,
+            height=10,
+            undo=False,
+            maxundo=0,
+            autoseparators=False,
+            wrap=tk.NONE
+        )
+        # left writable so inserts don't need to toggle state, key presses are blocked instead
+        self.console.bind("<Key>", self.block_edit)
+        self.console.bind("<<Paste>>", lambda e: "break")
+        self.console.bind("<<Cut>>", lambda e: "break")
+        self.x_scroll = ttk.Scrollbar(self, orient=tk.HORIZONTAL, command=self.console.xview)
+        self.console.configure(xscrollcommand=self.x_scroll.set)
+        # bound once, these are called on every poll
+        self._get_nowait = self.queue.get_nowait
+        self._insert = self.console.insert
+        self._see = self.console.see
+        self.console.grid(row=0, column=0, stick="nesw")
+        self.x_scroll.grid(row=1, column=0, stick="ew")
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
         self.process_logs()
@@ -42,23 +75,50 @@ class LogDisplay(ttk.LabelFrame):
 
         :param msg: formatted message to add
         """
-        self.console.configure(state=tk.NORMAL)
-        self.console.insert(tk.END, msg)
-        self.console.configure(state=tk.DISABLED)
-        self.console.see(tk.END)
+        self.add_many([msg])
+
+    def add_many(self, msgs: Iterable[str]):
+        """
+        Add messages to end of console window with a single insert, then scroll
+        once to see the last. Oldest lines are dropped once the console exceeds
+        its line limit
+
+        :param msgs: formatted messages to add
+        """
+        end = tk.END
+        self._insert(end, ''.join(msgs))
+        excess = int(self.console.index('end-1c').split('.')[0]) - self._max_lines
+        if excess > 0:
+            self.console.delete('1.0', f'{excess + 1}.0')
+        self._see(end)
+
+    @staticmethod
+    def block_edit(event):
+        """
+        Stops the user typing in the console, only copy and select all are let through
+
+        :param event: key event
+        :return: "break" to stop the key reaching the text widget
+        """
+        if event.state & 0x4 and event.keysym.lower() in ('c', 'a'):
+            return None
+        return "break"
 
     def process_logs(self):
         """
-        Get message from queue, if message add it to the window,
-        otherwise do nothing. Checks every 100ms while application is running
+        Get all waiting messages from queue, if any add them to the window
+        in one go, otherwise do nothing. Checks every poll_ms while application is running
         """
+        get_nowait = self._get_nowait
+        pending = []
         try:
-            msg = self.queue.get(timeout=0.01)
+            while True:
+                pending.append(get_nowait())
         except queue.Empty:
             pass
-        else:
-            self.add(msg)
-        self.after(100, self.process_logs)
+        if pending:
+            self.add_many(pending)
+        self.after(self.poll_ms, self.process_logs)
 
 
 class DirectoryChooser(ttk.Frame):
@@ -96,7 +156,7 @@ class DirectoryChooser(ttk.Frame):
         self.logger.debug("Launching directory file dialog...")
         out = filedialog.askdirectory(title=title, **options)
         if out:
-            self.logger.debug(f"Directory chosen: {out}")
+            self.logger.debug("Directory chosen: %s", out)
             self.dir_var.set(out)
             self.event_generate("<<path_updated>>")
         else:
@@ -112,19 +172,46 @@ class DirectoryChooser(ttk.Frame):
         return self.dir_var.get()
 
 
+class DirectoryWatcher(FileSystemEventHandler):
+    """
+    Watchdog event handler which posts a <<files_changed>> event to a queue
+    when files with a certain extension are added, removed or renamed.
+    Runs on the observer thread so tk is never touched here, the queue
+    is drained on the main thread
+    """
+    def __init__(self, events: queue.Queue, extension: str):
+        super(DirectoryWatcher, self).__init__()
+        self.events = events
+        self.extension = '.' + extension.lower()
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type == 'modified':
+            return
+        paths = (event.src_path, getattr(event, 'dest_path', ''))
+        if any(p.lower().endswith(self.extension) for p in paths):
+            self.events.put(("<<files_changed>>", None))
+
+
 class FileList(ttk.Frame):
     """
     Tkinter widget used to show a list of files matching an extension
-    in a certain directory
+    in a certain directory. Directory listings are cached until the directory
+    is modified. If watchdog is installed and an event queue is given, a
+    <<files_changed>> event is posted to it when matching files change
     """
-    def __init__(self, master, extension="", **options):
+    def __init__(self, master, extension="", events: queue.Queue = None, **options):
         super(FileList, self).__init__(master, **options)
         self.extension = extension
+        self.events = events
+        self.directory = ""
+        self._files = []
+        self._index = {}
+        self._cache: Dict[str, Tuple[int, List[str]]] = {}
+        self._observer = None
+        self._watch = None
 
-        self.file_list = tk.StringVar(value=[])
         self.listbox = tk.Listbox(
             self,
-            listvariable=self.file_list,
             selectmode="multiple"
         )
         self.clear_btn = ttk.Button(
@@ -169,11 +256,87 @@ class FileList(ttk.Frame):
         :param directory: directory to search
         """
         self.logger.debug("Updating file list...")
-        files = [
-            path.basename(f)
-            for f in glob.glob(path.join(directory, f"*.{self.extension}"))
-        ]
-        self.file_list.set(sorted(files))
+        if directory != self.directory:
+            self.watch(directory)
+        self.directory = directory
+        try:
+            files = self.scan(directory)
+        except OSError as e:
+            # e.g. the folder was deleted or renamed, show it as empty
+            self.logger.warning("Could not list %s: %s", directory, e)
+            self._cache.pop(directory, None)
+            files = []
+        self._files = files
+        self._index = {name: i for i, name in enumerate(self._files)}
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *self._files)
+
+    def scan(self, directory: str) -> List[str]:
+        """
+        Sorted names of matching files in directory, reused from the cache
+        while the directory's mtime is unchanged
+
+        :param directory: directory to search
+        :return: matching file names
+        """
+        mtime = os.stat(directory).st_mtime_ns
+        cached = self._cache.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        ext = '.' + self.extension.lower()
+        with os.scandir(directory) as it:
+            files = [
+                e.name
+                for e in it
+                if e.name.lower().endswith(ext) and e.is_file(follow_symlinks=False)
+            ]
+        files.sort()
+        self._cache[directory] = (mtime, files)
+        return files
+
+    def refresh(self, event=None):
+        """
+        Rescans the current directory, keeping the current selection
+
+        :param event:
+        """
+        if not self.directory:
+            return
+        selected = self.get_selected()
+        self.update_list(self.directory)
+        self.set_selected(selected)
+
+    def watch(self, directory: str):
+        """
+        Watches directory for changes to matching files, does nothing
+        if watchdog isn't installed or there is no event queue. If the directory
+        can't be watched a warning is logged and the list just isn't refreshed
+
+        :param directory: directory to watch
+        """
+        if Observer is None or self.events is None:
+            return
+        if self._observer is None:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        if self._watch is not None:
+            self._observer.unschedule(self._watch)
+            self._watch = None
+        try:
+            self._watch = self._observer.schedule(DirectoryWatcher(self.events, self.extension), directory)
+        except OSError as e:
+            self.logger.warning("Not watching %s for changes: %s", directory, e)
+
+    def stop_watching(self):
+        """
+        Stops watching the current directory
+        """
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+            self._watch = None
 
     def get_list(self) -> List[str]:
         """
@@ -181,8 +344,7 @@ class FileList(ttk.Frame):
 
         :return: file list
         """
-        files = re.sub(r"[()']", "", self.file_list.get()).split(',')
-        return [s.strip() for s in files]
+        return self._files
 
     def get_selected(self) -> List[str]:
         """
@@ -190,10 +352,7 @@ class FileList(ttk.Frame):
 
         :return: selected file list
         """
-        try:
-            return self.listbox.selection_get().split('\n')
-        except tk.TclError:
-            return []
+        return [self._files[i] for i in self.listbox.curselection()]
 
     def set_selected(self, dwgs: List[str]):
         """
@@ -202,17 +361,32 @@ class FileList(ttk.Frame):
         :param dwgs: drawings to select in list
         """
         self.clear_selection()
-        self.logger.debug(f"Changing selected drawings to {dwgs}")
-        files = self.get_list()
+        self.logger.debug("Changing selected drawings to %s", dwgs)
         for d in dwgs:
-            idx = files.index(d)
-            self.listbox.selection_set(idx, idx)
+            idx = self._index.get(d)
+            if idx is not None:
+                self.listbox.selection_set(idx)
 
 
 class BatchJobber(object):
     """
     Main window class
     """
+    __slots__ = (
+        'master', 'title',
+        'log_window', 'drawing_dir', 'drawing_list',
+        'publish_option_var', 'publish_option', 'run_button', 'progress_bar',
+        'status_var', 'status_label',
+        'job_running', 'log_queue', 'failed_drawings', 'has_failed_drawings', 'failed_list',
+        'drawing_filter', 'log_dispatcher', 'ui_events',
+    )
+
+    # failure reason and the header shown above those drawings in the warning box
+    FAILED_SECTIONS = (
+        ('open', "These drawings are open, please close them:\n"),
+        ('xref', "These drawings have unbound xrefs, please check them:\n"),
+        ('unknown', "\nSomething is wrong with these drawings:\n"),
+    )
 
     def __init__(self, master: tk.Tk):
         self.master = master
@@ -220,27 +394,35 @@ class BatchJobber(object):
 
         self.log_window = LogDisplay(master)
         self.drawing_dir = DirectoryChooser(master, label_text="Drawing Folder")
-        self.drawing_list = FileList(master, extension="dwg")
+        # worker callbacks and the directory watcher post (event, data) here,
+        # tk events are only generated on the main thread
+        self.ui_events = queue.Queue()
+        self.drawing_list = FileList(master, extension="dwg", events=self.ui_events)
         self.publish_option_var = tk.BooleanVar(value=True)
         self.publish_option = ttk.Checkbutton(master, text="Publish PDF", variable=self.publish_option_var)
         self.run_button = ttk.Button(master, text="Run", command=self.run)
         self.progress_bar = ttk.Progressbar(master, mode='determinate')
+        self.status_var = tk.StringVar()
+        self.status_label = ttk.Label(master, textvariable=self.status_var)
 
         self.ui_bindings()
         self.ui_build()
 
-        manager = mp.Manager()
         self.job_running = False
 
-        self.log_queue = manager.Queue(-1)
-        self.failed_drawings = manager.Queue()
+        # bounded so a flood of worker messages can't pile up, see BatchingQueueHandler
+        self.log_queue = mp.Queue(1024)
+        # filled by the drawing processor in this process, ended with None once checks finish
+        self.failed_drawings = queue.Queue()
         self.has_failed_drawings = False
         self.failed_list = {'all': [], 'open': [], 'xref': [], 'unknown': []}
-        self.drawing_filter = DrawingProcessor(self.log_queue, fail_queue=self.failed_drawings)
 
         self.log_dispatcher = LogDispatcher(self.log_queue, self.log_window.queue)
+        # only workers go through the log queue, this process logs to the handlers directly
+        configure_main_logging(self.log_dispatcher.handlers)
+        self.drawing_filter = DrawingProcessor(self.log_queue, fail_queue=self.failed_drawings)
 
-        autocad_console()
+        self.process_ui_events()
 
     def ui_bindings(self):
         """
@@ -251,6 +433,7 @@ class BatchJobber(object):
         self.master.bind("<<build_finished>>", self.processing_done)
         self.master.bind("<<build_error>>", self.processing_error)
         self.drawing_dir.bind("<<path_updated>>", self.update_drawing_list)
+        self.master.bind("<<files_changed>>", self.drawing_list.refresh)
 
     def ui_build(self):
         """
@@ -263,22 +446,44 @@ class BatchJobber(object):
         self.publish_option.grid(row=2, column=0, padx=5, pady=5)
         self.run_button.grid(row=2, column=1, padx=10, pady=5)
         self.progress_bar.grid(row=3, column=0, columnspan=2, padx=10, stick="ew")
-        self.progress_bar.grid_remove()
-        self.log_window.grid(row=4, column=0, columnspan=2, stick="nesw")
+        self.status_label.grid(row=4, column=0, columnspan=2, padx=10, stick="w")
+        self.log_window.grid(row=5, column=0, columnspan=2, stick="nesw")
 
         self.master.grid_rowconfigure(1, weight=3)
-        self.master.grid_rowconfigure(4, weight=1)
+        self.master.grid_rowconfigure(5, weight=1)
         self.master.grid_columnconfigure(0, weight=1)
         self.master.grid_columnconfigure(1, weight=1)
 
+    def ui_job_start(self):
+        """
+        Puts the ui into the running state in one go, disabling the run button
+        and starting the progress bar. The bar stays gridded so no relayout is needed
+        """
+        self.job_running = True
+        self.status_var.set("Running...")
+        self.run_button.configure(state=tk.DISABLED)
+        self.progress_bar.configure(mode='indeterminate')
+        self.progress_bar.start(25)
+
+    def ui_job_finish(self):
+        """
+        Resets the ui from the running state so a new job can be triggered
+        """
+        self.job_running = False
+        self.progress_bar.stop()
+        self.progress_bar.configure(mode='determinate', value=0)
+        self.run_button.configure(state=tk.NORMAL)
+
     def update_drawing_list(self, event):
         """
-        Event triggered when new directory is chosen. Refreshes file list
+        Event triggered when a directory is chosen. Refreshes file list,
+        choosing the same directory again picks up any new drawings
 
         :param event:
         """
-        logging.info(f"Changed drawing directory to {self.drawing_dir.get()}")
-        self.drawing_list.update_list(self.drawing_dir.get())
+        drawing_dir = self.drawing_dir.get()
+        logging.info("Changed drawing directory to %s", drawing_dir)
+        self.drawing_list.update_list(drawing_dir)
 
     def run(self):
         """
@@ -291,23 +496,32 @@ class BatchJobber(object):
             logging.error("No drawings selected")
             return
 
-        self.run_button.configure(state=tk.DISABLED)
-        self.progress_bar.grid()
-        self.progress_bar.configure(mode='indeterminate')
-        self.progress_bar.start(25)
-
-        self.job_running = True
+        self.ui_job_start()
         self.has_failed_drawings = False
 
         self.drawing_filter.set_build_options(publish=self.publish_option_var.get())
         self.drawing_filter.process(
             drawings,
             self.drawing_dir.get(),
-            filter_callback=lambda: self.master.event_generate("<<filter_finished>>"),
-            build_callback=lambda: self.master.event_generate("<<build_finished>>"),
-            error_callback=lambda e: self.master.event_generate("<<build_error>>", data=str(e))
+            filter_callback=lambda: self.ui_events.put(("<<filter_finished>>", None)),
+            build_callback=lambda: self.ui_events.put(("<<build_finished>>", None)),
+            error_callback=lambda e: self.ui_events.put(("<<build_error>>", str(e)))
         )
 
+    def process_ui_events(self):
+        """
+        Generates any tk events posted by the drawing processor callbacks
+        and the directory watcher.
+        Checks every 20ms while application is running
+        """
+        try:
+            while True:
+                name, data = self.ui_events.get_nowait()
+                self.master.event_generate(name, data=data)
+        except queue.Empty:
+            pass
+        self.master.after(20, self.process_ui_events)
+
     def filtering_done(self, event):
         """
         Event generated when drawing processor has finished filtering.
@@ -317,23 +531,17 @@ class BatchJobber(object):
 
         :param event:
         """
-        self.failed_list['all'].clear()
-        self.failed_list['open'].clear()
-        self.failed_list['xref'].clear()
-        self.failed_list['unknown'].clear()
+        buckets = {'open': [], 'xref': [], 'unknown': []}
         for dwg in iter(self.failed_drawings.get, None):
-            self.has_failed_drawings = True
-            self.failed_list['all'].append(dwg['dwg'])
-            if dwg['reason'] == 'open':
-                self.failed_list['open'].append(dwg['dwg'])
-            elif dwg['reason'] == 'xref':
-                self.failed_list['xref'].append(dwg['dwg'])
-            else:
-                self.failed_list['unknown'].append(dwg['dwg'])
+            buckets.get(dwg['reason'], buckets['unknown']).append(dwg['dwg'])
+        self.failed_list.update(buckets)
+        self.has_failed_drawings = any(buckets.values())
         if self.has_failed_drawings:
+            self.failed_list['all'] = list(chain.from_iterable(buckets.values()))
             mbox.showwarning(self.title + " Warning", self.generate_failed_string())
             self.drawing_list.set_selected(self.failed_list['all'])
         else:
+            self.failed_list['all'] = []
             self.drawing_list.clear_selection()
 
     def generate_failed_string(self) -> str:
@@ -342,40 +550,39 @@ class BatchJobber(object):
 
         :return: string for warning box
         """
-        failed_string = ""
-        if self.failed_list['open']:
-            failed_string += "These drawings are open, please close them:\n"
-            failed_string += '\n'.join(self.failed_list['open']) + '\n\n'
-        if self.failed_list['xref']:
-            failed_string += "These drawings have unbound xrefs, please check them:\n"
-            failed_string += '\n'.join(self.failed_list['xref']) + '\n\n'
-        if self.failed_list['unknown']:
-            failed_string += "\nSomething is wrong with these drawings:\n"
-            failed_string += '\n'.join(self.failed_list['unknown']) + '\n\n'
-        return failed_string
+        parts = []
+        for reason, header in self.FAILED_SECTIONS:
+            drawings = self.failed_list[reason]
+            if drawings:
+                parts.append(header)
+                parts.append('\n'.join(drawings))
+                parts.append('\n\n')
+        return ''.join(parts)
 
     def processing_done(self, event):
         """
         Triggered when drawing processor has finished building drawings.
-        Resets ui so that a new job can be triggered.
+        Resets ui so that a new job can be triggered, and reports the result
+        in the status line rather than a message box
 
         :param event:
         """
-        self.run_button.configure(state=tk.NORMAL)
-        self.progress_bar.stop()
-        self.progress_bar.grid_remove()
-        self.job_running = False
-        if not self.has_failed_drawings:
-            mbox.showinfo(self.title, "All done!")
+        self.ui_job_finish()
+        self.progress_bar.configure(value=self.progress_bar['maximum'])
+        failed_builds = self.drawing_filter.failed_builds
+        if failed_builds:
+            logging.warning("%s drawings failed to build, see the errors above", failed_builds)
+        if not self.has_failed_drawings and not failed_builds:
+            self.status_var.set("All done!")
         else:
             for dwg in self.failed_list['open']:
-                logging.warning(f"{dwg} is open in AutoCAD please close it to process")
+                logging.warning("%s is open in AutoCAD please close it to process", dwg)
             for dwg in self.failed_list['xref']:
-                logging.warning(f"{dwg} has unbound xrefs, fix in AutoCAD and rerun")
+                logging.warning("%s has unbound xrefs, fix in AutoCAD and rerun", dwg)
             for dwg in self.failed_list['unknown']:
-                logging.warning(f"{dwg} has failed for some reason :(")
-            mbox.showwarning(self.title, "All done!\nSome drawings had errors and weren't processed.\n"
-                                         "See the log window for more detail")
+                logging.warning("%s has failed for some reason :(", dwg)
+            self.status_var.set("All done! Some drawings had errors and weren't processed, "
+                                "see the log window for more detail")
 
     def processing_error(self, event):
         """
@@ -385,11 +592,10 @@ class BatchJobber(object):
 
         :param event:
         """
-        self.run_button.configure(state=tk.NORMAL)
-        self.progress_bar.stop()
-        self.progress_bar.grid_remove()
-        self.job_running = False
-        logging.critical(event.data)
+        self.ui_job_finish()
+        self.status_var.set("No drawings were processed")
+        # tkinter doesn't pass event data through, the processor has logged the error itself
+        logging.critical("Processing stopped, see the error above")
         mbox.showerror(self.title + " Error", "No drawings were processed. Something bad happened")
 
     def on_quit(self):
@@ -402,6 +608,7 @@ class BatchJobber(object):
             mbox.showwarning(self.title, "Job is still running!")
             return
         self.drawing_filter.stop()
+        self.drawing_list.stop_watching()
         logging.info("Quitting...")
         self.log_dispatcher.stop()
         self.master.destroy()
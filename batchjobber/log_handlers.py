@@ -1,56 +1,178 @@
+import copy
 import logging
 import logging.handlers
-import logging.config
 import multiprocessing as mp
-from typing import Dict
+import queue
+from typing import List
 
 
-class LogDispatcher:
+class LogDispatcher(logging.handlers.QueueListener):
     """
-    Logging process wrapper class which handles starting and stopping the dispatcher
+    Listens to the log queue on a background thread of the main process and
+    passes records straight to the console and log window handlers. Records
+    may arrive one at a time or as lists from a BatchingQueueHandler. Everything
+    waiting on the queue is drained per wakeup so the window gets one message per burst
     """
-    def __init__(self, log_queue: mp.Queue, window_queue: mp.Queue, start: bool = True):
-        self.stop_event = mp.Event()
-        self.log_queue = log_queue
-        self.window_queue = window_queue
-        self.log_process = mp.Process(
-            target=log_listener,
-            args=(self.log_queue, self.stop_event, generate_listener_config(self.window_queue))
+    max_batch = 500
+
+    def __init__(self, log_queue: mp.Queue, window_queue: queue.Queue, start: bool = True):
+        super(LogDispatcher, self).__init__(
+            log_queue,
+            *generate_listener_handlers(window_queue),
+            respect_handler_level=True
         )
+        # set when drain takes the sentinel, handed back by the next dequeue
+        self.sentinel_seen = False
         if start:
             self.start()
 
-    def start(self):
-        logging.debug("Starting logging process...")
-        self.log_process.start()
-
-    def stop(self):
-        logging.debug("Stopping logging process...")
-        self.stop_event.set()
-        self.log_process.join()
-
-
-def log_listener(q, stop_event, config):
-    """
-    Process which listens to the log queue and handles records.
-    Waits for main process to signal completion via the event. 
-    The listener is then stopped and the process exits.
-    """
-    logging.config.dictConfig(config)
-    listener = logging.handlers.QueueListener(q, SimpleLogHandler())
-    listener.start()
-    stop_event.wait()
-    listener.stop()
+    def enqueue_sentinel(self):
+        """
+        Puts the stop sentinel on the queue, waiting for room as the log queue is bounded
+        """
+        self.queue.put(self._sentinel)
+
+    def dequeue(self, block: bool):
+        if self.sentinel_seen:
+            self.sentinel_seen = False
+            return self._sentinel
+        return self.queue.get(block)
+
+    def drain(self, item) -> List[logging.LogRecord]:
+        """
+        Collects item and anything else waiting on the queue into a single batch.
+        If the sentinel is reached it is held back for the monitor thread's next
+        dequeue rather than put back, which could block on a full queue
+
+        :param item: record or list of records already taken from the queue
+        :return: records in the batch
+        """
+        batch = []
+        while True:
+            if isinstance(item, list):
+                batch.extend(item)
+            else:
+                batch.append(item)
+            if len(batch) >= self.max_batch:
+                break
+            try:
+                item = self.dequeue(False)
+            except queue.Empty:
+                break
+            if item is self._sentinel:
+                self.sentinel_seen = True
+                break
+        return batch
 
-
-class SimpleLogHandler:
+    def handle(self, record):
+        records = [self.prepare(r) for r in self.drain(record)]
+        for handler in self.handlers:
+            accepted = [r for r in records if r.levelno >= handler.level]
+            if not accepted:
+                continue
+            if isinstance(handler, LogWindowHandler):
+                handler.handle_batch(accepted)
+            else:
+                for r in accepted:
+                    handler.handle(r)
+
+
+class BatchingQueueHandler(logging.handlers.BufferingHandler):
     """
-    A simple handler for logging events. It runs in the listener process 
-    and dispatches events to loggers based on the name in the received record
+    Logging handler for worker processes. Buffers records and puts them
+    on the queue as a single list, so the queue is written to once per batch
+    instead of once per record. The buffer is flushed when full or on any
+    record at or above flush_level, so only chatty lower level records wait.
+    If the queue is bounded and full, records below WARNING are dropped and
+    counted rather than blocking the worker, the count is sent as a single
+    warning once the queue has room again
     """
-    def handle(self, record):
-        logger = logging.getLogger(record.name)
-        logger.handle(record)
+    def __init__(self, queue, capacity: int = 32, flush_level: int = logging.INFO):
+        super(BatchingQueueHandler, self).__init__(capacity)
+        self.queue = queue
+        self.flush_level = flush_level
+        self.dropped = 0
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Makes a picklable copy of the record. Only the message is merged and the
+        traceback rendered to text, the full formatting is left to the dispatcher
+
+        :param record: record to prepare
+        :return: prepared copy of record
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def dropped_record(self) -> logging.LogRecord:
+        """
+        Makes a prepared warning record reporting how many records were dropped
+
+        :return: warning record
+        """
+        return logging.makeLogRecord({
+            'name': 'log',
+            'levelno': logging.WARNING,
+            'levelname': logging.getLevelName(logging.WARNING),
+            'msg': "%d log messages dropped, the log couldn't keep up" % self.dropped,
+        })
+
+    def shouldFlush(self, record):
+        return len(self.buffer) >= self.capacity or record.levelno >= self.flush_level
+
+    def flush(self):
+        """
+        Prepares buffered records and puts them on the queue as one list. Like
+        QueueHandler, a record that can't be prepared or sent is passed to
+        handleError rather than raising into the caller, and the buffer is
+        always cleared so a bad record can't stay behind
+        """
+        self.acquire()
+        try:
+            records = []
+            try:
+                for r in self.buffer:
+                    try:
+                        records.append(self.prepare(r))
+                    except Exception:
+                        self.handleError(r)
+            finally:
+                self.buffer.clear()
+            if records:
+                try:
+                    self.put_records(records)
+                except Exception:
+                    self.handleError(records[-1])
+        finally:
+            self.release()
+
+    def put_records(self, records: List[logging.LogRecord]):
+        """
+        Puts prepared records on the queue. If the queue is full, records below
+        WARNING are dropped and counted, the rest wait for room
+
+        :param records: prepared records to send
+        """
+        dropped = self.dropped
+        if dropped:
+            records.insert(0, self.dropped_record())
+        try:
+            self.queue.put_nowait(records)
+            self.dropped = 0
+        except queue.Full:
+            if dropped:
+                del records[0]
+            kept = [r for r in records if r.levelno >= logging.WARNING]
+            self.dropped += len(records) - len(kept)
+            if kept:
+                self.queue.put(kept)
 
 
 class LogWindowHandler(logging.Handler):
@@ -59,74 +181,67 @@ class LogWindowHandler(logging.Handler):
     formats the record and adds the string msg to the queue for the window 
     to handle
     """
+    terminator = '\n'
+
     def __init__(self, queue):
         super(LogWindowHandler, self).__init__()
         self.queue = queue
 
     def emit(self, record):
-        msg = self.format(record)
+        msg = self.format(record) + self.terminator
         self.queue.put(msg)
 
+    def handle_batch(self, records: List[logging.LogRecord]):
+        """
+        Formats records and adds them to the queue as a single string
 
-def generate_worker_config(q: mp.Queue, level: str = 'DEBUG') -> Dict:
+        :param records: records to add
+        """
+        msgs = [self.format(r) + self.terminator for r in records if self.filter(r)]
+        if msgs:
+            self.queue.put(''.join(msgs))
+
+
+def configure_main_logging(handlers: List[logging.Handler], level: int = logging.DEBUG):
+    """
+    Sets up logging in the gui process by giving the root logger the dispatcher's
+    handlers directly. Records logged here skip the worker log queue, so they are
+    never held in a batch, dropped or blocked on a full queue
+
+    :param handlers: handlers to log to, normally LogDispatcher.handlers
+    :param level: logging level (default DEBUG)
     """
-    Generates logging config for worker processes (builder and processor)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = list(handlers)
+
+
+def configure_worker_logging(q: mp.Queue, level: int = logging.DEBUG):
+    """
+    Sets up logging in a worker process (builder and processor) by setting a
+    queue handler on the root logger directly, skipping dictConfig. Any handlers
+    inherited from a forked parent are replaced
 
     :param q: queue to use for logging
     :param level: logging level (default DEBUG)
-    :return: config to be passed to logging.config.dictConfig
     """
-    log_config = {
-        'version': 1,
-        'handlers': {
-            'queue': {
-                'class': 'logging.handlers.QueueHandler',
-                'queue': q,
-            },
-        },
-        'root': {
-            'level': level,
-            'handlers': ['queue'],
-        },
-    }
-    return log_config
-
-
-def generate_listener_config(q: mp.Queue) -> Dict:
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [BatchingQueueHandler(q)]
+
+
+def generate_listener_handlers(q: queue.Queue) -> List[logging.Handler]:
     """
-    Generates logging config for the dispatcher process
+    Generates the handlers used by the log dispatcher
 
     :param q: console window queue
-    :return: config dict
+    :return: console and window handlers
     """
-    log_config = {
-        'version': 1,
-        'formatters': {
-            'simple': {
-                'class': 'logging.Formatter',
-                'format': '%(levelname)-8s %(message)s'
-            },
-            'window': {
-                'class': 'logging.Formatter',
-                'format': '%(levelname)-8s %(message)s\n'
-            },
-        },
-        'handlers': {
-            'console': {
-                'class': 'logging.StreamHandler',
-                'level': 'DEBUG',
-                'formatter': 'simple',
-            },
-            'window': {
-                'class': 'batchjobber.log_handlers.LogWindowHandler',
-                'level': 'INFO',
-                'queue': q,
-                'formatter': 'window'
-            }
-        },
-        'root': {
-            'level': 'DEBUG',
-            'handlers': ['console', 'window']
-        }
-    }
-    return log_config
+    console = logging.StreamHandler()
+    console.setLevel(logging.DEBUG)
+    console.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+
+    window = LogWindowHandler(q)
+    window.setLevel(logging.INFO)
+    window.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+    return [console, window]
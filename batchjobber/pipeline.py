@@ -1,77 +1,218 @@
-import glob
 import multiprocessing as mp
-import re
+import os
+import queue
 import subprocess as sp
+import threading
 import logging
-import logging.config
 import logging.handlers
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
-from typing import List, Optional, Callable
+from typing import List, Optional, Callable, Set, Tuple
 from os import path
 
-from .log_handlers import generate_worker_config
+from .log_handlers import configure_worker_logging
 from .utility import autocad_console
 
+# hard coded as autocad doesn't trust network locations by default
+SCRIPT_DIR = path.abspath(r"Z:\CAD Standards\Lisp & Script files")
+XREF_SCRIPT = path.join(SCRIPT_DIR, "test_xrefs.scr")
+
+# accoreconsole pads its output with nulls and backspaces
+_CONSOLE_NOISE = b'\x00\x08'
+_XREF_LABEL = b"Total Xref(s):"
+# cleaned output kept between reads so a count split across chunks is still found
+_XREF_TAIL = 64
+# stops windows allocating a console window for every accoreconsole run
+_NO_WINDOW = getattr(sp, 'CREATE_NO_WINDOW', 0)
+
+# accoreconsole path handed over by the main process when a worker starts
+_console = ""
+
+
+def init_worker(log_queue: mp.Queue, console: str):
+    """
+    Initialises a worker process, configuring logging once
+
+    :param log_queue: queue used for log messaging
+    :param console: full path of accoreconsole
+    """
+    global _console
+    _console = console
+    configure_worker_logging(log_queue)
+
+
+def xref_digits(output: bytearray, start: int) -> Tuple[int, int]:
+    """
+    Finds the digits following the xref label, skipping whitespace after the label
+
+    :param output: cleaned console output
+    :param start: index of the xref label in output
+    :return: start and end index of the digits, equal if there are none (yet)
+    """
+    first = start + len(_XREF_LABEL)
+    size = len(output)
+    while first < size and output[first] in b" \t\r\n":
+        first += 1
+    end = first
+    while end < size and output[end] in b"0123456789":
+        end += 1
+    return first, end
+
+
+def scan_xref_counts(output: bytearray, count: Optional[int], final: bool = False) -> Tuple[Optional[int], int]:
+    """
+    Scans output for xref counts, keeping the last one found like the original greedy match
+
+    :param output: cleaned console output
+    :param count: last count found in earlier output
+    :param final: True if no more output will follow
+    :return: last count found, and the index output can be dropped up to
+    """
+    scanned = 0
+    start = output.find(_XREF_LABEL)
+    while start >= 0:
+        first, end = xref_digits(output, start)
+        if end == len(output) and not final:
+            # digits may carry on in the next chunk
+            return count, start
+        if end > first:
+            count = int(output[first:end])
+        scanned = end
+        start = output.find(_XREF_LABEL, end)
+    return count, max(len(output) - _XREF_TAIL, scanned)
+
+
+def read_xref_count(cmd: List[str], chunk_size: int = 65536) -> Optional[int]:
+    """
+    Runs the xref test in accoreconsole and reads the xref count from its output.
+    Output is cleaned and scanned as it arrives, only a short tail is kept between reads.
+    If the count is printed more than once the last one is used. The console is left
+    to exit on its own, killing it early can leave the drawing locked
+
+    :param cmd: accoreconsole command to run
+    :param chunk_size: maximum bytes read from the console at a time
+    :return: number of xrefs, or None if the count wasn't found in the output
+    """
+    count = None
+    tail = bytearray()
+    with sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL, creationflags=_NO_WINDOW) as proc:
+        for chunk in iter(partial(proc.stdout.read1, chunk_size), b''):
+            tail += chunk.translate(None, _CONSOLE_NOISE)
+            count, done = scan_xref_counts(tail, count)
+            del tail[:done]
+    if proc.returncode:
+        raise sp.CalledProcessError(proc.returncode, cmd)
+    count, _ = scan_xref_counts(tail, count, final=True)
+    return count
+
+
+def check_drawing(drawing_path: str) -> Optional[int]:
+    """
+    Checks drawing to ensure no unbound xrefs
+
+    :param drawing_path: absolute path of drawing file to check
+    :return: number of unbound xrefs, or None if the check gave no result
+    """
+    drawing = path.basename(drawing_path)
+    logging.debug("Checking %s", drawing)
+    cmd = [
+        _console,
+        "/i", drawing_path,
+        "/s", XREF_SCRIPT
+    ]
+    xrefs = read_xref_count(cmd)
+    if xrefs == 0:
+        logging.info("%s passed drawing check", drawing)
+    elif xrefs:
+        logging.warning("%s failed drawing check - has unbound xrefs", drawing)
+    return xrefs
+
+
+def build_drawing(drawing_path: str, script: str) -> int:
+    """
+    Runs the build script on drawing in an autocad console window and returns the exit code
+
+    :param drawing_path: absolute path of drawing to run build script on
+    :param script: full path of build script
+    :return: exit code of script (should always be 0)
+    """
+    drawing = path.basename(drawing_path)
+    logging.debug("Building %s...", drawing)
+    cmd = [
+        _console,
+        "/i", drawing_path,
+        "/s", script
+    ]
+    out_code = sp.check_call(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL, creationflags=_NO_WINDOW)
+    logging.info("Built - %s", drawing)
+    return out_code
+
 
 class DrawingProcessor(object):
     """
     Class to filter drawing files based on certain checks
-    to prevent broken drawings being passed to the builder
+    to prevent broken drawings being passed to the builder.
+    Checks and builds share one pool of worker processes, a drawing that
+    passes its check is submitted for building as soon as the check finishes
     """
 
-    def __init__(self, log_queue: mp.Queue, fail_queue: Optional[mp.Queue] = None):
+    def __init__(self, log_queue: mp.Queue, fail_queue: Optional[queue.Queue] = None,
+                 num_workers: int = 0, console: Optional[str] = None):
         """
-        Initialise drawing processor. Creates manager for creating queues, and initiates
-        processing pool as well as default values for callbacks and options
+        Initialise drawing processor. Creates the worker pool as well as
+        default values for callbacks and options. The pool is kept for every
+        run until stop is called, worker processes are started as needed
 
         :param log_queue: queue used for log messaging
         :param fail_queue: queue to pass failed drawings, if None creates its own
+        :param num_workers: number of worker processes, or cpu_count if 0
+        :param console: full path of accoreconsole, if None it is found here
         """
-        self.log_config = generate_worker_config(log_queue)
-        logging.config.dictConfig(self.log_config)
         self.log_queue = log_queue
         self.logger = logging.getLogger('filter')
 
-        self.manager = mp.Manager()
-        self.pool = mp.Pool()
+        # found once in this process so workers never have to search for it
+        self.console = console or autocad_console()
+        self.fail_queue = fail_queue or queue.Queue()
+        self.num_workers = num_workers or mp.cpu_count()
+        self.executor = self.create_executor()
 
-        self.fail_queue = fail_queue or self.manager.Queue()
-        self.build_queue = None
-
-        self.builders = []
-        self.num_builders = 0
+        # checks and builds still running, updated from the executor's callback thread.
+        # run is bumped when a job starts or is aborted so late callbacks can be ignored
+        self.lock = threading.Lock()
+        self.run = 0
+        self.checks_pending = 0
+        self.builds_pending = 0
+        self.failed_builds = 0
 
         self.drawing_dir = ""
+        self.drawing_prefix = ""
+        self.script = ""
         self.filter_callback = None
         self.build_callback = None
+        self.error_callback = None
         self.publish_pdfs = True
 
-    def reset_builders(self, drawing_dir: str, num_builders: Optional[int] = 0):
+    def create_executor(self) -> ProcessPoolExecutor:
         """
-        Resets all builder processes with correct arguments. If num_builders is provided
-        makes that many builders, otherwise use cpu_count
+        Creates the worker pool, workers are set up by init_worker as they start
 
-        :param drawing_dir: drawing folder location
-        :param num_builders: number of builder processes to start, or cpu_count if 0
-        """
-        for b in self.builders:
-            b.terminate()
-        self.build_queue = self.manager.JoinableQueue()
-        self.num_builders = num_builders or mp.cpu_count()
-        self.builders = [
-            Builder(self.build_queue, drawing_dir, self.publish_pdfs, self.log_queue)
-            for _ in range(self.num_builders)
-        ]
-        for b in self.builders:
-            b.start()
+        :return: new worker pool
+        """
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=init_worker,
+            initargs=(self.log_queue, self.console)
+        )
 
     def stop(self):
         """
-        Stops and kills builder processes and filtering pool
+        Stops the worker pool, cancelling any drawings not yet started
         """
-        for b in self.builders:
-            b.terminate()
-        self.pool.terminate()
+        with self.lock:
+            self.run += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
     def set_build_options(self, publish: bool = True):
         """
@@ -81,6 +222,16 @@ class DrawingProcessor(object):
         """
         self.publish_pdfs = publish
 
+    def build_script(self) -> str:
+        """
+        Build script to run on passed drawings, depending on build options
+
+        :return: full path of script
+        """
+        if self.publish_pdfs:
+            return path.join(SCRIPT_DIR, "zipship_publish.scr")
+        return path.join(SCRIPT_DIR, "zipship.scr")
+
     # noinspection PyTypeChecker
     def process(self, drawings: List[str], drawing_dir: str,
                 filter_callback: Optional[Callable[[], None]] = None,
@@ -88,170 +239,219 @@ class DrawingProcessor(object):
                 error_callback: Optional[Callable[[BaseException], None]] = None) -> None:
         """
         Initiates filtering process on drawings, if checks are passed the drawings
-        are then passed to the builder processes through a queue
+        are then submitted to the same worker pool to be built
 
         :param drawings: drawings to process
         :param drawing_dir: drawing folder location
         :param filter_callback: callback on filter complete
-        :param build_callback: callback on build complete
-        :param error_callback: callback on error in processing
+        :param build_callback: callback on build complete, check failed_builds for failures
+        :param error_callback: callback on error in processing, the run is abandoned
         """
-        self.logger.info(f"Starting checks...")
-
-        self.drawing_dir = drawing_dir
+        with self.lock:
+            self.run += 1
+            run = self.run
+            self.checks_pending = 0
+            self.builds_pending = 0
+            self.failed_builds = 0
         self.filter_callback = filter_callback
         self.build_callback = build_callback
+        self.error_callback = error_callback
 
-        for idx, drawing in enumerate(drawings):
-            if self.check_open(drawing):
-                del drawings[idx]
-                self.fail_queue.put({'dwg': drawing, 'reason': 'open'})
-                self.logger.error(f"{drawing} is currently open and will not be processed, please close it")
+        # drop anything left over from an aborted run that never finished its checks
+        try:
+            while True:
+                self.fail_queue.get_nowait()
+        except queue.Empty:
+            pass
 
-        self.reset_builders(drawing_dir)
+        try:
+            self.start_checks(run, drawings, drawing_dir)
+        except Exception as e:
+            self.abort(run, e)
 
-        if not drawings:
-            filter_callback()
-            error_callback()
-            return
-
-        self.pool = mp.Pool()
-        self.pool.map_async(
-            partial(
-                self.check_drawing,
-                drawing_dir=drawing_dir,
-                pass_queue=self.build_queue,
-                fail_queue=self.fail_queue,
-                log_config=self.log_config
-            ),
-            drawings,
-            callback=self.filter_complete
-        )
+    def start_checks(self, run: int, drawings: List[str], drawing_dir: str):
+        """
+        Removes open drawings and submits a check for every other drawing
 
-    def filter_complete(self, val):
+        :param run: current run
+        :param drawings: drawings to process
+        :param drawing_dir: drawing folder location
         """
-        Callback function called when we have finished initial processing of teh drawings
+        self.logger.info("Starting checks...")
+
+        # resolved once here so each task only carries the drawing's path
+        drawing_dir = path.abspath(drawing_dir)
+        self.drawing_dir = drawing_dir
+        # joining with "" adds the separator only where needed, e.g. not for a drive root
+        self.drawing_prefix = path.join(drawing_dir, "")
+        self.script = self.build_script()
+
+        open_drawings = self.open_drawings()
+        closed_drawings = []
+        for drawing in drawings:
+            name = drawing[:-4] if drawing.lower().endswith(".dwg") else path.splitext(drawing)[0]
+            if path.normcase(name) in open_drawings:
+                self.fail_queue.put({'dwg': drawing, 'reason': 'open'})
+                self.logger.error("%s is currently open and will not be processed, please close it", drawing)
+            else:
+                closed_drawings.append(drawing)
+        drawings = closed_drawings
 
-        :param val:  return value from check_drawing
+        if not drawings:
+            self.fail_queue.put(None)
+            if self.filter_callback:
+                self.filter_callback()
+            raise ValueError("No drawings left to process")
+
+        with self.lock:
+            self.checks_pending = len(drawings)
+        for drawing in drawings:
+            if not self.submit(run, partial(self.check_done, run, drawing),
+                               check_drawing, self.drawing_path(drawing)):
+                return
+
+    def submit(self, run: int, callback: Callable[[Future], None], fn: Callable, *args) -> bool:
         """
-        self.pool.close()
-        self.fail_queue.put(None)
-        for _ in range(self.num_builders):
-            # need to add one sentinel for each builder process
-            # to ensure all files are processed and we exit gracefully
-            self.build_queue.put(None)
+        Submits a task to the worker pool, aborting the run if the pool can't take it
 
-        if self.filter_callback:
-            self.filter_callback()
+        :param run: run the task belongs to
+        :param callback: called with the future once the task is done
+        :param fn: function to run in a worker
+        :param args: arguments for fn
+        :return: True if the task was submitted
+        """
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError as e:
+            self.abort(run, e)
+            return False
+        future.add_done_callback(callback)
+        return True
 
-        # wait for all the build processes to finish
-        self.build_queue.join()
-        self.logger.info("Build process done!")
+    def abort(self, run: int, error: BaseException):
+        """
+        Stops a run after an error, callbacks still to come from the run are ignored.
+        A broken or shut down pool is replaced so the next run can go ahead
 
-        if self.build_callback:
-            self.build_callback()
+        :param run: run to abort
+        :param error: error that stopped the run
+        """
+        with self.lock:
+            if run != self.run:
+                return
+            self.run += 1
+        self.logger.error("Processing stopped: %s", error)
+        if isinstance(error, RuntimeError):
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.create_executor()
+        if self.error_callback:
+            self.error_callback(error)
+
+    def drawing_path(self, drawing: str) -> str:
+        """
+        Full path of a drawing in the current drawing directory
 
-    def check_open(self, drawing: str) -> bool:
+        :param drawing: drawing file name
+        :return: absolute path of drawing
         """
-        Checks if drawing is open in autocad by looking for dwl files in directory
+        return self.drawing_prefix + drawing
 
-        :param drawing: drawing to check
-        :return: True if open
+    def check_done(self, run: int, drawing: str, future: Future):
         """
-        name = path.splitext(drawing)[0]
-        files = glob.glob(path.join(path.abspath(self.drawing_dir), name + ".dwl"))
-        if files:
-            return True
-        else:
-            return False
+        Callback for a finished drawing check. Passed drawings are submitted for
+        building, failed drawings are placed on the fail queue
 
-    @staticmethod
-    def check_drawing(drawing: str, drawing_dir: str, pass_queue: mp.Queue, fail_queue: mp.Queue, log_config: dict) -> bool:
-        """
-        Checks drawing to ensure no unbound xrefs
-
-        :param drawing: drawing files to check
-        :param drawing_dir: location of drawing
-        :param pass_queue: place here if check passed
-        :param fail_queue: place here if check failed
-        :param log_config: ensures logging is handled properly
-        :return: False if an error occured, True otherwise
-        """
-        logging.config.dictConfig(log_config)
-        logging.debug(f"Checking {drawing}")
-        # hard coded as autocad doesn't trust network locations by default
-        script_dir = path.abspath(r"Z:\CAD Standards\Lisp & Script files")
-        cmd = [
-            autocad_console(log=False),
-            "/i", path.join(path.abspath(drawing_dir), drawing),
-            "/s", path.join(script_dir, "test_xrefs.scr")
-        ]
-        out = sp.check_output(cmd, shell=True, stderr=sp.DEVNULL)
-        result = out.replace(b'\x00', b'').replace(b'\x08', b'').decode('ascii')
-        match = re.match(r".+Total Xref\(s\): (\d+)", re.sub(r"[\r\n]", "", result))
-        if not match:
-            return False
-        if int(match.group(1)) == 0:
-            logging.info(f"{drawing} passed drawing check")
-            pass_queue.put(drawing)
+        :param run: run the check belongs to
+        :param drawing: drawing that was checked
+        :param future: finished check_drawing call
+        """
+        if future.cancelled() or run != self.run:
+            return
+        try:
+            xrefs = future.result()
+        except BrokenProcessPool as e:
+            self.abort(run, e)
+            return
+        except Exception as e:
+            self.logger.error("%s could not be checked", drawing, exc_info=e)
+            xrefs = None
+        if xrefs == 0:
+            with self.lock:
+                self.builds_pending += 1
+            if not self.submit(run, partial(self.build_done, run, drawing),
+                               build_drawing, self.drawing_path(drawing), self.script):
+                return
+        elif xrefs:
+            self.fail_queue.put({'dwg': drawing, 'reason': 'xref'})
         else:
-            logging.warning(f"{drawing} failed drawing check - has unbound xrefs")
-            fail_queue.put({'dwg': drawing, 'reason': 'xref'})
-        return True
+            self.fail_queue.put({'dwg': drawing, 'reason': 'unknown'})
+        self.task_done(run, check=True)
 
+    def build_done(self, run: int, drawing: str, future: Future):
+        """
+        Callback for a finished drawing build, failed builds are counted
 
-class Builder(mp.Process):
-    """
-    Build process. Requires a queue containing drawing names to build, the directory they are located,
-    whether or not PDFs should be published, and the log queue for message passing.
-    """
+        :param run: run the build belongs to
+        :param drawing: drawing that was built
+        :param future: finished build_drawing call
+        """
+        if future.cancelled() or run != self.run:
+            return
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self.abort(run, error)
+            return
+        if error:
+            self.logger.error("Failed to build %s", drawing, exc_info=error)
+            with self.lock:
+                self.failed_builds += 1
+        self.task_done(run, check=False)
 
-    def __init__(self, queue: mp.JoinableQueue, drawing_dir: str, publish: bool, log_queue: mp.Queue):
+    def task_done(self, run: int, check: bool):
         """
-        Initialise build process
+        Marks a check or build as finished. Triggers filter_complete once every check
+        is done, and build_complete once every check and build is done
 
-        :param queue: Build queue where drawings to be processed are placed
-        :param drawing_dir: Root directory of drawings
-        :param publish: Publish PDFs or not
-        :param log_queue: Message queue for logging
+        :param run: run the check or build belongs to
+        :param check: True if a check finished, False if a build finished
         """
-        super(Builder, self).__init__()
-        self.log_config = generate_worker_config(log_queue)
-        self.queue = queue
-        self.drawing_dir = path.abspath(drawing_dir)
-        # hard coded as autocad doesn't trust network locations by default
-        self.script_dir = path.abspath(r"Z:\CAD Standards\Lisp & Script files")
-        if publish:
-            self.script = path.join(self.script_dir, "zipship_publish.scr")
-        else:
-            self.script = path.join(self.script_dir, "zipship.scr")
+        with self.lock:
+            if run != self.run:
+                return
+            if check:
+                self.checks_pending -= 1
+            else:
+                self.builds_pending -= 1
+            checks_finished = check and self.checks_pending == 0
+            all_finished = self.checks_pending == 0 and self.builds_pending == 0
+        if checks_finished:
+            self.filter_complete()
+        if all_finished:
+            self.build_complete()
+
+    def filter_complete(self):
+        """
+        Called when we have finished initial processing of the drawings
+        """
+        self.fail_queue.put(None)
+        if self.filter_callback:
+            self.filter_callback()
 
-    def run(self) -> None:
+    def build_complete(self):
         """
-        Starts the build process
+        Called when every passed drawing has been built, failed_builds
+        holds the number of builds that failed
         """
-        logging.config.dictConfig(self.log_config)
-        while True:
-            drawing = self.queue.get()
-            if drawing is None:
-                self.queue.task_done()
-                break
-            logging.debug(f"Building {drawing}...")
-            self.build_drawing(drawing)
-            logging.info(f"Built - {drawing}")
-            self.queue.task_done()
-        return
+        self.logger.info("Build process done!")
+        if self.build_callback:
+            self.build_callback()
 
-    def build_drawing(self, drawing: str) -> int:
+    def open_drawings(self) -> Set[str]:
         """
-        Runs the build script on drawing in an autocad console window and returns the exit code
+        Finds drawings open in autocad by looking for dwl files in directory,
+        the directory is only listed once for the whole batch
 
-        :param drawing: drawing to run build script on
-        :return: exit code of script (should always be 0)
+        :return: names of open drawings without extension, normalised with path.normcase
         """
-        cmd = [
-            autocad_console(log=False),
-            "/i", path.join(self.drawing_dir, drawing),
-            "/s", path.join(self.script_dir, self.script)]
-        out_code = sp.check_call(cmd, shell=True, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
-        return out_code
+        with os.scandir(self.drawing_dir) as it:
+            return {path.normcase(e.name[:-4]) for e in it if e.name.lower().endswith(".dwl")}
@@ -1,10 +1,14 @@
+import functools
 import glob
 import logging
 import re
 import platform
 from os import path
 
+ACAD_VERSION_RE = re.compile(r"AutoCAD \d{4}")
 
+
+@functools.lru_cache(maxsize=None)
 def autocad_basepath(log=True):
     if "Windows" not in platform.platform():
         if log:
@@ -15,14 +19,14 @@ def autocad_basepath(log=True):
         if log:
             logging.error("Could not find an installed version of AutoCAD")
         return ""
-    for ver in sorted(acad_versions, reverse=True):
-        if re.match(r"AutoCAD \d{4}", path.basename(ver)):
-            if log:
-                logging.info(f"Using {path.basename(ver)}")
-                logging.debug(f"AutoCAD base path is {ver}")
-            return ver
+    ver = max((v for v in acad_versions if ACAD_VERSION_RE.match(path.basename(v))), default=None)
+    if ver and log:
+        logging.info("Using %s", path.basename(ver))
+        logging.debug("AutoCAD base path is %s", ver)
+    return ver
 
 
+@functools.lru_cache(maxsize=None)
 def autocad_console(log=True):
     base = autocad_basepath(log=log)
     console_path = path.join(base, "accoreconsole.exe")